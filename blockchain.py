@@ -1,6 +1,10 @@
 import hashlib
 import json
+import logging
 import requests
+from requests.adapters import HTTPAdapter
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 from textwrap import dedent
 from time import time
 from uuid import uuid4
@@ -8,14 +12,38 @@ from urllib.parse import urlparse
 
 from flask import Flask, jsonify, request
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+logger = logging.getLogger(__name__)
+
 class Blockchain(object):
     def __init__(self):
         self.chain = []
-        self.current_transactions = []
+        # Hashes of the blocks in self.chain, so each block is only ever
+        # serialized and hashed once
+        self.hashes = []
+        # Number of blocks at the start of self.chain known to be valid
+        self.validated_through = 0
+        # Pending transactions are kept column-wise and only turned into
+        # dicts when they are written into a block
+        self.tx_senders = []
+        self.tx_recipients = []
+        self.tx_amounts = []
         self.nodes = set()
+        # Leading zero bits a proof's hash needs, used both to mine and to
+        # validate so this node accepts its own chain. 16 is 4 hex zeros
+        self.difficulty_bits = 16
+
+        # Keep connections to neighbours alive between consensus rounds
+        self.session = requests.Session()
+        self.session.mount('http://', HTTPAdapter(pool_connections=64, pool_maxsize=64))
 
         # Create the genesis block
         self.new_block(previous_hash=1, proof=100)
+        self.validated_through = 1
 
     def new_block(self, previous_hash, proof):
         # Create a new block and add it to the chain
@@ -28,14 +56,28 @@ class Blockchain(object):
         block  = {
             'index': len(self.chain) + 1,
             'timestamp': time(),
-            'transactions': self.current_transactions,
+            'transactions': [
+                {'sender': sender, 'recipient': recipient, 'amount': amount}
+                for sender, recipient, amount
+                in zip(self.tx_senders, self.tx_recipients, self.tx_amounts)
+            ],
             'proof': proof,
-            'previous_hash': previous_hash or self.hash(self.chain[-1]),
+            'previous_hash': previous_hash or self.hashes[-1],
         }
 
         # Reset the current  transactions list
-        self.current_transactions = []
+        self.tx_senders = []
+        self.tx_recipients = []
+        self.tx_amounts = []
+
+        # A block that correctly extends our validated chain is valid too
+        if (self.chain and self.validated_through == len(self.chain)
+                and block['previous_hash'] == self.hashes[-1]
+                and self.valid_proof(self.chain[-1]['proof'], proof, self.difficulty_bits)):
+            self.validated_through += 1
+
         self.chain.append(block)
+        self.hashes.append(self.hash(block))
         return block
 
     def new_transaction(self, sender, recipient, amount):
@@ -48,11 +90,9 @@ class Blockchain(object):
         :return: <int> The index of the block that will hold this transaction
         """
 
-        self.current_transactions.append({
-            'sender': sender,
-            'recipient': recipient,
-            'amount': amount,
-        })
+        self.tx_senders.append(sender)
+        self.tx_recipients.append(recipient)
+        self.tx_amounts.append(amount)
         return self.last_block['index'] + 1
 
     @staticmethod
@@ -63,8 +103,9 @@ class Blockchain(object):
         :return: <str>
         """
 
-        # Dictionary must be ordered, or hashes will be inconsistent
-        block_string = json.dumps(block, sort_keys=True).encode()
+        # Dictionary must be ordered, or hashes will be inconsistent.
+        # Compact separators keep the encoding canonical with fewer bytes to hash
+        block_string = json.dumps(block, sort_keys=True, separators=(',', ':')).encode()
         return hashlib.sha256(block_string).hexdigest()
 
     @property
@@ -75,32 +116,68 @@ class Blockchain(object):
     def proof_of_work(self, last_proof):
         """
         Simple Proof of Work Algorithm:
-          - Find a number p' such that hash(pp') contains leading 4 zeros, where p is the previous p'
+          - Find a number p' such that SHA-256(p || p') has at least difficulty_bits
+            leading zero bits, where p is the previous p'
+          - p and p' are each encoded as an unsigned 8 byte little-endian integer
           - p is the previous proof, and p' is the new proof
 
         :param last_proof: <int>
         :return: <int>
         """
 
+        # hashlib is backed by OpenSSL, which already picks its SHA-NI / AVX2
+        # code paths at runtime, so keep the loop itself tight: absorb
+        # last_proof once and only feed the nonce for each guess.
+        # Proofs are hashed as fixed 8 byte little-endian words, no int to str
+        target = self.proof_target(self.difficulty_bits)
+        base = hashlib.sha256(last_proof.to_bytes(8, 'little'))
         proof = 0
-        while self.valid_proof(last_proof, proof) is False:
+        while True:
+          guess_hash = base.copy()
+          guess_hash.update(proof.to_bytes(8, 'little'))
+          if guess_hash.digest() < target:
+            return proof
           proof +=1
 
-        return proof
-
     @staticmethod
-    def valid_proof(last_proof, proof):
+    def valid_proof(last_proof, proof, difficulty_bits=16):
         """
-        Validates the Proof: does hash(last_proof, proof) contains 4 leading zeros?
+        Validates the Proof: does SHA-256(last_proof || proof), both encoded as
+        unsigned 8 byte little-endian integers, have at least difficulty_bits
+        leading zero bits? The digest is compared against proof_target.
+        Proofs that aren't ints in that range are invalid.
 
         :param last_proof: <int> Previous proof
         :param proof: <int> Current proof to validate
+        :param difficulty_bits: <int> Leading zero bits required, 16 is 4 hex zeros
         :return:  <bool> True if valid, False if not
         """
 
-        guess = f'{last_proof}{proof}'.encode()
-        guess_hash = hashlib.sha256(guess).hexdigest()
-        return guess_hash[:4] == "0000"
+        # Both proofs as 8 byte little-endian words, the same bytes proof_of_work hashes.
+        # Peers can send anything as a proof, only ints can be encoded
+        if type(last_proof) is not int or type(proof) is not int:
+            return False
+        try:
+            guess = last_proof.to_bytes(8, 'little') + proof.to_bytes(8, 'little')
+        except OverflowError:
+            # Negative or wider than 64 bits, never produced by proof_of_work
+            return False
+        guess_hash = hashlib.sha256(guess).digest()
+        return guess_hash < Blockchain.proof_target(difficulty_bits)
+
+    @staticmethod
+    @lru_cache(maxsize=None)
+    def proof_target(difficulty_bits):
+        """
+        Digests below the target have at least difficulty_bits leading zero bits.
+        Equal-length big-endian bytes compare like the integers they encode, so
+        checking a proof is a single bytes comparison. Built once per difficulty.
+
+        :param difficulty_bits: <int> Leading zero bits required, at least 1
+        :return: <bytes> 32 byte target
+        """
+
+        return (1 << (256 - difficulty_bits)).to_bytes(32, 'big')
 
     def register_node(self, address):
         """
@@ -113,35 +190,61 @@ class Blockchain(object):
         parsed_url = urlparse(address)
         self.nodes.add(parsed_url.netloc)
 
-    def valid_chain(self, chain):
+    def valid_chain(self, chain, start=1, hashes=None):
         """
         Determine if a given blockchain is valid
 
         :param chain: <list> A blockchain
+        :param start: <int> Index of the first block to check, blocks before it are trusted
+        :param hashes: (Optional) <list> Filled with the hashes of chain[start - 1:]
         :return: <bool> True if valid, False if not
         """
 
-        last_block = chain[0]
-        current_index = 1
+        last_block = chain[start - 1]
+        current_index = start
 
         while current_index < len(chain):
             block = chain[current_index]
-            print(f'{last_block}')
-            print(f'{block}')
-            print("\n-----------\n")
+            logger.debug("validating block %s against block %s", block['index'], last_block['index'])
             # Check the hash of the block is correct
-            if block['previous_hash'] != self.hash(last_block):
+            last_hash = self.hash(last_block)
+            if block['previous_hash'] != last_hash:
                 return False
+            if hashes is not None:
+                hashes.append(last_hash)
 
             # Check that the proof of work is correct
-            if not self.valid_proof(last_block['proof'], block['proof']):
+            if not self.valid_proof(last_block['proof'], block['proof'], self.difficulty_bits):
                 return False
 
             last_block = block
             current_index += 1
 
+        if hashes is not None:
+            hashes.append(self.hash(last_block))
+
+        if chain is self.chain:
+            self.validated_through = len(chain)
+
         return True
 
+    def validated_prefix(self, chain):
+        """
+        Find the first block of a chain that still needs validating. A chain
+        whose block k links to our validated block k - 1 shares our validated
+        prefix, valid_chain confirms it by rehashing chain[k - 1] anyway.
+        Blocks before k are not checked, so use our own copies of them.
+
+        :param chain: <list> A blockchain
+        :return: <int> Index to pass to valid_chain as start
+        """
+
+        index = min(self.validated_through, len(chain) - 1)
+        while index > 1 and chain[index]['previous_hash'] != self.hashes[index - 1]:
+            index -= 1
+
+        return max(index, 1)
+
     def resolve_conflicts(self):
         """
         This is our consensus algorithm, it resolves conflicts
@@ -152,32 +255,100 @@ class Blockchain(object):
 
         neighbours = self.nodes
         new_chain = None
+        new_hashes = None
 
         # We're only looking for chains longer than ours
         max_length = len(self.chain)
 
-        # Grab and verify the chains from all the nodes in our network
-        for node in neighbours:
-            response = requests.get(f'http://{node}/chain')
-
-            if response.status_code == 200:
-                length = response.json()['length']
-                chain = response.json()['chain']
-
-                # Check if the length is longer and the chain is valid
-                if length > max_length and self.valid_chain(chain):
-                    max_length = length
-                    new_chain = chain
+        if not neighbours:
+            return False
+
+        # Grab the chains from all the nodes in our network at once, the
+        # round trips overlap instead of adding up. Anyone can register nodes,
+        # so cap the workers rather than starting a thread per node
+        with ThreadPoolExecutor(max_workers=min(len(neighbours), 32)) as executor:
+            responses = list(executor.map(self.fetch_chain, neighbours))
+
+        # And verify them
+        for response in responses:
+            if response is not None and response.status_code == 200:
+                # Decode the body once, it holds the whole chain
+                data = response.json()
+                length = data['length']
+                chain = data['chain']
+
+                # The reported length must be the real one, and a chain needs a
+                # second block before valid_chain has checked any proof in it
+                if len(chain) < 2 or len(chain) != length:
+                    continue
+
+                # Check if the length is longer and the chain is valid.
+                # Blocks before start are the ones we already validated, keep
+                # our own copies of them rather than trusting the neighbour's
+                if length > max_length:
+                    start = self.validated_prefix(chain)
+                    hashes = []
+                    if self.valid_chain(chain, start, hashes):
+                        shared = start if start > 1 else 0
+                        max_length = length
+                        new_chain = self.chain[:shared] + chain[shared:]
+                        # hashes starts at chain[start - 1], reuse what valid_chain computed
+                        new_hashes = self.hashes[:shared] + hashes[shared - start + 1:]
 
         if new_chain:
+            self.hashes = new_hashes
             self.chain = new_chain
+            self.validated_through = len(new_chain)
             return True
 
         return False
 
+    def fetch_chain(self, node):
+        """
+        Fetch the chain of a neighbouring node
+
+        :param node: <str> Address of node. e.g. '192.168.0.5:5002'
+        :return: <Response> or None if the node could not be reached
+        """
+
+        try:
+            return self.session.get(f'http://{node}/chain', timeout=5)
+        except requests.exceptions.RequestException:
+            return None
+
 # Instantiate our Node
 app = Flask(__name__)
 
+def fast_jsonify(obj):
+    # orjson encodes in native code, which matters once the chain gets long.
+    # Falls back to Flask's encoder when it isn't installed, or for values
+    # orjson can't encode such as ints wider than 64 bits from a peer's chain
+    if orjson is None:
+        return jsonify(obj)
+    try:
+        body = orjson.dumps(obj)
+    except orjson.JSONEncodeError:
+        return jsonify(obj)
+    return app.response_class(body, mimetype='application/json')
+
+def parse_json(exact_keys=()):
+    # Decode the request body with orjson when available, None unless it is
+    # valid JSON sent as application/json, just like request.get_json.
+    # orjson silently turns ints wider than 64 bits into floats, so Flask
+    # decodes it instead when one of exact_keys comes back as a float
+    if not request.is_json:
+        return None
+    if orjson is None:
+        return request.get_json(silent=True)
+    try:
+        values = orjson.loads(request.get_data())
+    except orjson.JSONDecodeError:
+        # orjson is stricter about some input, e.g. NaN, leave the call to Flask
+        return request.get_json(silent=True)
+    if isinstance(values, dict) and any(isinstance(values.get(key), float) for key in exact_keys):
+        return request.get_json(silent=True)
+    return values
+
 # Generate a globally unique address for this node
 node_identifier = str(uuid4()).replace('-', '')
 
@@ -199,8 +370,8 @@ def mine():
         amount=1,
     )
 
-    # Forge the new Block by adding it to the chain
-    block = chain.new_block(last_block, proof)
+    # Forge the new Block by adding it to the chain, linked to the hash of the last one
+    block = chain.new_block(None, proof)
 
     response = {
         'message': "New Block Forged",
@@ -209,11 +380,13 @@ def mine():
         'proof': block['proof'],
         'previous_hash': block['previous_hash'],
     }
-    return jsonify(response), 200
+    return fast_jsonify(response), 200
 
 @app.route('/transactions/new', methods=['POST'])
 def new_transaction():
-    values = request.get_json()
+    values = parse_json(exact_keys=('amount',))
+    if not isinstance(values, dict):
+        return 'Invalid JSON payload', 400
 
     # Check the required fields are in the POST payload
     required = ['sender', 'recipient', 'amount']
@@ -223,7 +396,7 @@ def new_transaction():
     # Create a new transaction
     index = chain.new_transaction(values['sender'], values['recipient'], values['amount'])
     response = {'message': f'Transaction will be added to Block {index}'}
-    return jsonify(response), 201
+    return fast_jsonify(response), 201
 
 @app.route('/chain', methods=['GET'])
 def full_chain():
@@ -231,11 +404,13 @@ def full_chain():
         'chain': chain.chain,
         'length': len(chain.chain),
     }
-    return jsonify(response), 200
+    return fast_jsonify(response), 200
 
 @app.route('/nodes/register', methods=['POST'])
 def register_nodes():
-    values = request.get_json()
+    values = parse_json()
+    if not isinstance(values, dict):
+        return 'Invalid JSON payload', 400
 
     nodes = values.get('nodes')
     if nodes is None:
@@ -248,7 +423,7 @@ def register_nodes():
         'message': 'New nodes have been added',
         'total_nodes': list(chain.nodes),
     }
-    return jsonify(response), 201
+    return fast_jsonify(response), 201
 
 @app.route('/nodes/resolve', methods=['GET'])
 def consensus():
@@ -264,7 +439,7 @@ def consensus():
             'message': 'Our chain is authoritative',
             'chain': chain.chain
         }
-    return jsonify(response), 200
+    return fast_jsonify(response), 200
 
 if __name__ == '__main__':
     from argparse import ArgumentParser
@@ -0,0 +1,101 @@
+import json
+import unittest
+
+from blockchain import Blockchain
+
+
+class FakeResponse(object):
+    status_code = 200
+
+    def __init__(self, chain):
+        self.chain = chain
+
+    def json(self):
+        # Round trip through JSON like a real /chain response
+        return json.loads(json.dumps({'chain': self.chain, 'length': len(self.chain)}))
+
+
+def make_node():
+    node = Blockchain()
+    node.difficulty_bits = 8
+    return node
+
+
+def mine_blocks(node, count):
+    for _ in range(count):
+        proof = node.proof_of_work(node.last_block['proof'])
+        node.new_transaction(sender="0", recipient="miner", amount=1)
+        node.new_block(None, proof)
+
+
+def resolve_against(node, chain):
+    node.nodes = {'peer:5000'}
+    node.fetch_chain = lambda address: FakeResponse(chain)
+    return node.resolve_conflicts()
+
+
+class ResolveConflictsTest(unittest.TestCase):
+    def setUp(self):
+        # Our node adopts the peer's chain, so both share a validated prefix
+        self.peer = make_node()
+        mine_blocks(self.peer, 3)
+        self.node = make_node()
+        self.assertTrue(resolve_against(self.node, self.peer.chain))
+        self.assertEqual(self.node.validated_through, 4)
+
+    def assertConsistent(self, node):
+        self.assertEqual(node.hashes, [node.hash(block) for block in node.chain])
+        self.assertEqual(node.validated_through, len(node.chain))
+        self.assertTrue(node.valid_chain(node.chain))
+
+    def test_extension_only_validates_new_blocks(self):
+        ours = list(self.node.chain)
+        mine_blocks(self.peer, 2)
+
+        extended = FakeResponse(self.peer.chain).json()['chain']
+        self.assertEqual(self.node.validated_prefix(extended), 4)
+
+        self.assertTrue(resolve_against(self.node, self.peer.chain))
+        self.assertEqual(len(self.node.chain), 6)
+        for mine, kept in zip(ours, self.node.chain):
+            self.assertIs(mine, kept)
+        self.assertConsistent(self.node)
+
+    def test_fork_is_validated_from_the_fork_point(self):
+        fork = make_node()
+        fork.chain = FakeResponse(self.peer.chain[:2]).json()['chain']
+        fork.hashes = self.peer.hashes[:2]
+        mine_blocks(fork, 4)
+
+        forked = FakeResponse(fork.chain).json()['chain']
+        self.assertEqual(self.node.validated_prefix(forked), 2)
+
+        self.assertTrue(resolve_against(self.node, fork.chain))
+        self.assertEqual(self.node.hashes, fork.hashes)
+        self.assertConsistent(self.node)
+
+    def test_tampered_prefix_is_never_adopted(self):
+        mine_blocks(self.peer, 2)
+        original = json.loads(json.dumps(self.node.chain))
+
+        # Behind the fork point: the suffix is valid, but our prefix is kept
+        tampered = FakeResponse(self.peer.chain).json()['chain']
+        tampered[2]['transactions'] = [{'sender': 'evil', 'recipient': 'evil', 'amount': 1000}]
+        self.assertTrue(resolve_against(self.node, tampered))
+        self.assertEqual(json.loads(json.dumps(self.node.chain[:4])), original)
+        self.assertConsistent(self.node)
+
+        # At the fork point: rehashing the last shared block catches it
+        mine_blocks(self.peer, 1)
+        tampered = FakeResponse(self.peer.chain).json()['chain']
+        tampered[5]['transactions'] = []
+        self.assertFalse(resolve_against(self.node, tampered))
+
+        # Without a shared prefix the whole chain is checked and rejected
+        tampered = FakeResponse(self.peer.chain).json()['chain']
+        tampered[2]['transactions'] = []
+        self.assertFalse(resolve_against(make_node(), tampered))
+
+
+if __name__ == '__main__':
+    unittest.main()